@@ -16,19 +16,142 @@
 __all__ = ["FunnelTokenizer"]
 
 from collections.abc import Iterable
+from itertools import repeat
+import functools
 import os
+import re
+import numpy as np
+from multiprocess import Pool, RLock
 from ..bert.tokenizer import BertTokenizer
 from .. import BasicTokenizer, WordpieceTokenizer
 from .. import PretrainedTokenizer
 import unicodedata
-from ..tokenizer_utils import _is_control
-
-
-def stem(token):
-    if token[:2] == "##":
-        return token[2:]
-    else:
-        return token
+from ..tokenizer_utils import _is_control, _is_punctuation, _is_symbol, _is_whitespace
+
+
+class _RematchTable(dict):
+    """
+    A `str.translate` table mapping a code point to its normalized form used
+    by `FunnelTokenizer.rematch`. Code points below `precomputed_size` (ASCII,
+    Latin and other common alphabets) are filled in advance, the others on
+    first use. Code points whose normalized form is not exactly one character
+    are recorded in `irregular`.
+    """
+
+    def __init__(self, do_lower_case, precomputed_size=0x600):
+        super().__init__()
+        self.do_lower_case = do_lower_case
+        self.irregular = set()
+        for cp in range(precomputed_size):
+            self.__missing__(cp)
+
+    def __missing__(self, cp):
+        ch = chr(cp)
+        if self.do_lower_case:
+            ch = ch.lower()
+            ch = unicodedata.normalize("NFD", ch)
+            ch = "".join([c for c in ch if unicodedata.category(c) != "Mn"])
+
+        ch = "".join([c for c in ch if not (ord(c) == 0 or ord(c) == 0xFFFD or _is_control(c))])
+        if len(ch) != 1:
+            self.irregular.add(cp)
+        self[cp] = ch
+        return ch
+
+
+# Shared by all tokenizers. Each table gains an entry for every distinct code point
+# it translates, so it is bounded by the size of Unicode (0x110000 code points),
+# in practice by the scripts seen in the inputs.
+_REMATCH_TABLES = {True: _RematchTable(True), False: _RematchTable(False)}
+
+
+class _BasicTokenizeTable(dict):
+    """
+    A lazily filled `str.translate` table which applies all per-character steps
+    of `BasicTokenizer.tokenize` (cleaning, CJK and punctuation splitting, lower
+    casing and accent stripping) to a code point, so that basic tokenization is
+    `text.translate(table).split()`. Code points for which the per-character
+    result may differ from tokenizing a whole word (final sigma lower casing, and
+    non-Mn combining marks reordered by NFD) are recorded in `unsafe`.
+    """
+
+    def __init__(self, do_lower_case, strip_accents, tokenize_chinese_chars):
+        super().__init__()
+        self.basic_tokenizer = BasicTokenizer(
+            do_lower_case=do_lower_case, tokenize_chinese_chars=tokenize_chinese_chars, strip_accents=strip_accents
+        )
+        self.unsafe = set()
+
+    def __missing__(self, cp):
+        tokenizer = self.basic_tokenizer
+        ch = chr(cp)
+        if cp == 0 or cp == 0xFFFD or _is_control(ch):
+            self[cp] = ""
+            return ""
+        if _is_whitespace(ch):
+            self[cp] = " "
+            return " "
+
+        if tokenizer.do_lower_case:
+            ch = ch.lower()
+            if cp == 0x03A3:
+                self.unsafe.add(cp)
+        if (tokenizer.do_lower_case and tokenizer.strip_accents is not False) or tokenizer.strip_accents:
+            if any(
+                unicodedata.combining(c) and unicodedata.category(c) != "Mn" for c in unicodedata.normalize("NFD", ch)
+            ):
+                self.unsafe.add(cp)
+            ch = tokenizer._run_strip_accents(ch)
+        ch = "".join([" %s " % c if _is_punctuation(c) or _is_symbol(c) else c for c in ch])
+        if tokenizer.tokenize_chinese_chars and tokenizer._is_chinese_char(cp):
+            ch = " %s " % ch
+        self[cp] = ch
+        return ch
+
+
+# One table per `(do_lower_case, strip_accents, tokenize_chinese_chars)` setting, at
+# most 12, shared by all tokenizers and growing like `_REMATCH_TABLES`.
+_BASIC_TOKENIZE_TABLES = {}
+
+
+class _FunnelBasicTokenizer(BasicTokenizer):
+    """
+    `BasicTokenizer` which runs the per-character steps through a cached
+    `str.translate` table in a single C-level pass, and falls back to
+    `BasicTokenizer.tokenize` when the result could differ.
+    """
+
+    def tokenize(self, text, never_split=None):
+        if never_split or self.never_split or not isinstance(text, str):
+            return super().tokenize(text, never_split=never_split)
+
+        key = (self.do_lower_case, self.strip_accents, self.tokenize_chinese_chars)
+        table = _BASIC_TOKENIZE_TABLES.get(key)
+        if table is None:
+            table = _BASIC_TOKENIZE_TABLES[key] = _BasicTokenizeTable(*key)
+
+        translated = text.translate(table)
+        if table.unsafe and not table.unsafe.isdisjoint(map(ord, text)):
+            return super().tokenize(text)
+        return translated.split()
+
+
+# Fixups applied when joining tokens back into a string, matched in one pass.
+# `" ' "` must not swallow a space followed by `.?!,`, which keeps the result
+# the same as replacing the patterns one after another in this order.
+_DETOK_MAP = {
+    " .": ".",
+    " ?": "?",
+    " !": "!",
+    " ,": ",",
+    " ' ": "'",
+    " n't": "n't",
+    " 'm": "'m",
+    " 's": "'s",
+    " 've": "'ve",
+    " 're": "'re",
+}
+_DETOK_PATTERN = re.compile(r" \.| \?| !| ,| ' (?![.?!,])| n't| 'm| 's| 've| 're")
 
 
 class FunnelTokenizer(BertTokenizer):
@@ -82,8 +205,27 @@ class FunnelTokenizer(BertTokenizer):
                 "`tokenizer = BertTokenizer.from_pretrained(PRETRAINED_MODEL_NAME)`".format(vocab_file)
             )
         self.vocab = self.load_vocabulary(vocab_file, unk_token=unk_token)
-        self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
+        self.basic_tokenizer = _FunnelBasicTokenizer(do_lower_case=do_lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, unk_token=unk_token)
+        self._build_caches()
+
+    def _build_caches(self):
+        # Word frequencies are Zipf distributed, so a small cache of wordpiece
+        # results per basic token avoids most of the wordpiece work. The cache
+        # is keyed on words rather than whole texts to keep its memory bounded,
+        # and wraps `self.wordpiece_tokenizer` rather than `self` to avoid a
+        # reference cycle. Cached lists are shared and must not be modified.
+        self._wordpiece_cache = functools.lru_cache(maxsize=8192)(self.wordpiece_tokenizer.tokenize)
+
+    def __getstate__(self):
+        # the cache wraps a bound method and is rebuilt after unpickling
+        state = self.__dict__.copy()
+        state.pop("_wordpiece_cache", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_caches()
 
     def __call__(
         self,
@@ -126,6 +268,39 @@ class FunnelTokenizer(BertTokenizer):
         """
         return len(self.vocab)
 
+    def _tokenize_impl(self, text):
+        """
+        Runs basic and wordpiece tokenization on `text`, wordpiece results are
+        cached per basic token by `self._wordpiece_cache`.
+        Args:
+            text (str): The text to be tokenized.
+
+        Returns:
+            tuple: A tuple of `(split_tokens, custom_tokens)`. `split_tokens` is
+            a list of wordpiece tokens, and `custom_tokens` is the same except
+            that unknown tokens are replaced by their original words.
+        """
+        # `unk_token` is a property, look it up and bind the tokenizers only once
+        unk_token = self.unk_token
+        wordpiece_tokenize = self._wordpiece_cache
+
+        split_tokens, unk_words = [], []
+        for token in self.basic_tokenizer.tokenize(text):
+            sub_tokens = wordpiece_tokenize(token)
+            if unk_token in sub_tokens:
+                offset = len(split_tokens)
+                unk_words.extend(
+                    (offset + i, token) for i, sub_token in enumerate(sub_tokens) if sub_token == unk_token
+                )
+            split_tokens.extend(sub_tokens)
+        if not unk_words:
+            return split_tokens, split_tokens
+
+        custom_tokens = list(split_tokens)
+        for index, token in unk_words:
+            custom_tokens[index] = token
+        return split_tokens, custom_tokens
+
     def _tokenize(self, text):
         """
         End-to-end tokenization for BERT models.
@@ -135,11 +310,20 @@ class FunnelTokenizer(BertTokenizer):
         Returns:
             list: A list of string representing converted tokens.
         """
-        split_tokens = []
-        for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
-        return split_tokens
+        return self._tokenize_impl(text)[0]
+
+    def _text_to_ids(self, text):
+        """
+        Converts `text` into a list of token ids. Wordpiece tokens are always in
+        the vocabulary, so added tokens can't change the result and the tokens
+        are looked up in the vocabulary dict directly rather than through
+        `convert_tokens_to_ids`.
+        """
+        vocab = self.vocab
+        token_to_idx = vocab.token_to_idx
+        return [
+            token_to_idx[token] if token in token_to_idx else vocab[token] for token in self._tokenize_impl(text)[0]
+        ]
 
     def tokenize(self, text):
         """
@@ -164,27 +348,16 @@ class FunnelTokenizer(BertTokenizer):
         """
 
         out_string = " ".join(tokens).replace(" ##", "").strip()
-        out_string = (
-            out_string.replace(" .", ".")
-            .replace(" ?", "?")
-            .replace(" !", "!")
-            .replace(" ,", ",")
-            .replace(" ' ", "'")
-            .replace(" n't", "n't")
-            .replace(" 'm", "'m")
-            .replace(" 's", "'s")
-            .replace(" 've", "'ve")
-            .replace(" 're", "'re")
-        )
-        return out_string
+        return _DETOK_PATTERN.sub(lambda m: _DETOK_MAP[m.group(0)], out_string)
 
     def num_special_tokens_to_add(self, pair=False):
         """
         Returns the number of added tokens when encoding a sequence with special tokens.
 
-        Note:
-            This encodes inputs and checks the number of added tokens, and is therefore not efficient. Do not put this
-            inside your training loop.
+        A Funnel sequence has the following format:
+        ::
+            - single sequence: ``<cls> X <sep>``
+            - pair of sequences: ``<cls> A <sep> B <sep>``
 
         Args:
             pair: Returns the number of added tokens in the case of a sequence pair if set to True, returns the
@@ -193,9 +366,7 @@ class FunnelTokenizer(BertTokenizer):
         Returns:
             Number of tokens added to sequences
         """
-        token_ids_0 = []
-        token_ids_1 = []
-        return len(self.build_inputs_with_special_tokens(token_ids_0, token_ids_1 if pair else None))
+        return 3 if pair else 2
 
     def build_offset_mapping_with_special_tokens(self, offset_mapping_0, offset_mapping_1=None):
         """
@@ -207,25 +378,39 @@ class FunnelTokenizer(BertTokenizer):
             - pair of sequences: `(0,0) A (0,0) B (0,0)``
 
         Args:
-            offset_mapping_ids_0 (:obj:`List[tuple]`):
+            offset_mapping_ids_0 (:obj:`List[tuple]` or :obj:`numpy.ndarray`):
                 List of char offsets to which the special tokens will be added.
-            offset_mapping_ids_1 (:obj:`List[tuple]`, `optional`):
+                It can also be an int array of shape `[seq_len, 2]`.
+            offset_mapping_ids_1 (:obj:`List[tuple]` or :obj:`numpy.ndarray`, `optional`):
                 Optional second list of char offsets for offset mapping pairs.
 
         Returns:
             :obj:`List[tuple]`: List of char offsets with the appropriate offsets of special tokens.
+            An array is returned if `offset_mapping_ids_0` is an array.
         """
+        if isinstance(offset_mapping_0, np.ndarray):
+            special = np.zeros((1, 2), dtype=offset_mapping_0.dtype)
+            if offset_mapping_1 is None:
+                return np.concatenate([special, offset_mapping_0, special])
+            return np.concatenate([special, offset_mapping_0, special, offset_mapping_1, special])
+
         if offset_mapping_1 is None:
             return [(0, 0)] + offset_mapping_0 + [(0, 0)]
 
         return [(0, 0)] + offset_mapping_0 + [(0, 0)] + offset_mapping_1 + [(0, 0)]
 
     def create_token_type_ids_from_sequences(self, token_ids_0, token_ids_1=None):
-        _sep = [self.sep_token_id]
-        _cls = [self.cls_token_id]
+        # <cls> A <sep> [B <sep>], segment ids of a pair are filled in a bytearray
+        len_0 = 1 + len(token_ids_0) + 1
         if token_ids_1 is None:
-            return len(_cls) * [self.cls_token_type_id] + len(token_ids_0 + _sep) * [0]
-        return len(_cls) * [self.cls_token_type_id] + len(token_ids_0 + _sep) * [0] + len(token_ids_1 + _sep) * [1]
+            token_type_ids = [0] * len_0
+        else:
+            len_1 = len(token_ids_1) + 1
+            segments = bytearray(len_0 + len_1)
+            segments[len_0:] = b"\x01" * len_1
+            token_type_ids = list(segments)
+        token_type_ids[0] = self.cls_token_type_id
+        return token_type_ids
 
     def get_special_tokens_mask(self, token_ids_0, token_ids_1=None, already_has_special_tokens=False):
         """
@@ -248,7 +433,8 @@ class FunnelTokenizer(BertTokenizer):
                     "You should not supply a second sequence if the provided sequence of "
                     "ids is already formatted with special tokens for the model."
                 )
-            return list(map(lambda x: 1 if x in [self.sep_token_id, self.cls_token_id] else 0, token_ids_0))
+            special_ids = {self.sep_token_id, self.cls_token_id}
+            return [int(x in special_ids) for x in token_ids_0]
 
         if token_ids_1 is not None:
             return [1] + ([0] * len(token_ids_0)) + [1] + ([0] * len(token_ids_1)) + [1]
@@ -282,23 +468,35 @@ class FunnelTokenizer(BertTokenizer):
             return ids, pair_ids, []
 
         if truncation_strategy == "longest_first":
-            overflowing_tokens = []
-            if pair_ids is None or len(ids) <= len(pair_ids):
-                for _ in range(num_tokens_to_remove):
-                    if pair_ids is None or len(ids) >= len(pair_ids):
-                        overflowing_tokens = [ids[-1]] + overflowing_tokens
-                        ids = ids[:-1]
-                    else:
-                        pair_ids = pair_ids[:-1]
-                window_len = min(len(ids), stride)
+            # Work out how many tokens the iterative "remove one token from the
+            # longest sequence" procedure takes from each side, then slice once.
+            len_ids = len(ids)
+            if pair_ids is None:
+                num_ids_to_remove = num_tokens_to_remove
+                if num_ids_to_remove > len_ids:
+                    raise IndexError("Input sequence is shorter than the number of tokens to remove.")
             else:
-                for _ in range(num_tokens_to_remove):
-                    if pair_ids is None or len(ids) > len(pair_ids):
-                        overflowing_tokens = [ids[-1]] + overflowing_tokens
-                        ids = ids[:-1]
-                    else:
-                        pair_ids = pair_ids[:-1]
-                window_len = min(len(ids), stride)
+                len_pair = len(pair_ids)
+                # First remove tokens from the longer sequence until both have the same length,
+                # then remove alternately, starting with `ids` on a tie when `ids` was not longer.
+                gap = min(num_tokens_to_remove, abs(len_ids - len_pair))
+                remain = num_tokens_to_remove - gap
+                if len_ids <= len_pair:
+                    if num_tokens_to_remove > len_ids + len_pair:
+                        raise IndexError("Input sequences are shorter than the number of tokens to remove.")
+                    num_ids_to_remove = (remain + 1) // 2
+                    num_pair_to_remove = gap + remain // 2
+                else:
+                    # `pair_ids` is popped first on a tie, and popping an empty `pair_ids` is a no-op
+                    num_ids_to_remove = gap + min(remain // 2, len_pair)
+                    num_pair_to_remove = min((remain + 1) // 2, len_pair)
+                if num_pair_to_remove > 0:
+                    pair_ids = pair_ids[: len_pair - num_pair_to_remove]
+            overflowing_tokens = []
+            if num_ids_to_remove > 0:
+                overflowing_tokens = ids[len_ids - num_ids_to_remove :]
+                ids = ids[: len_ids - num_ids_to_remove]
+            window_len = min(len(ids), stride)
             if window_len > 0:
                 overflowing_tokens = ids[-window_len:] + overflowing_tokens
         elif truncation_strategy == "only_first":
@@ -333,6 +531,8 @@ class FunnelTokenizer(BertTokenizer):
         return_length=False,
         return_overflowing_tokens=False,
         return_special_tokens_mask=False,
+        return_numpy_offsets=False,
+        num_workers=None,
     ):
         """
         Performs tokenization and uses the tokenized tokens to prepare model
@@ -391,6 +591,16 @@ class FunnelTokenizer(BertTokenizer):
             return_special_tokens_mask (bool, optional):
                 Whether to include special tokens mask information in the returned
                 dictionary. Defaults to `False`.
+            return_numpy_offsets (bool, optional):
+                Whether to return `offset_mapping` as an int32 `numpy.ndarray` of
+                shape `[seq_len, 2]` instead of a list of tuples. It is more compact
+                for long sequences. Defaults to `False`.
+            num_workers (int, optional):
+                Number of processes used to encode the batch. The batch is split
+                into `num_workers` contiguous shards which are encoded in parallel.
+                If set to 0, it doesn't use multiprocessing. If `None`, it is read
+                from the `PPNLP_TOKENIZER_NUM_WORKERS` environment variable, which
+                defaults to 0. Defaults to `None`.
         Returns:
             list[dict]:
                 The dict has the following optional items:
@@ -416,15 +626,87 @@ class FunnelTokenizer(BertTokenizer):
                 - **offset_mapping** (list[int], optional): list of pair preserving the
                   index of start and end char in original input for each token.
                   For a sqecial token, the index pair is `(0, 0)`. Included when
-                  `stride` works.
+                  `stride` works. It is an int32 `numpy.ndarray` when `return_numpy_offsets`
+                  is `True`.
                 - **overflow_to_sample** (int, optional): Index of example from which this
                   feature is generated. Included when `stride` works.
         """
 
+        if num_workers is None:
+            num_workers = int(os.environ.get("PPNLP_TOKENIZER_NUM_WORKERS", 0))
+        assert num_workers >= 0, "num_workers should be a non-negative value"
+        kwds = dict(
+            max_seq_len=max_seq_len,
+            pad_to_max_seq_len=pad_to_max_seq_len,
+            stride=stride,
+            is_split_into_words=is_split_into_words,
+            truncation_strategy=truncation_strategy,
+            return_position_ids=return_position_ids,
+            return_token_type_ids=return_token_type_ids,
+            return_attention_mask=return_attention_mask,
+            return_length=return_length,
+            return_overflowing_tokens=return_overflowing_tokens,
+            return_special_tokens_mask=return_special_tokens_mask,
+            return_numpy_offsets=return_numpy_offsets,
+        )
+        if num_workers > 1:
+            batch_text_or_text_pairs = list(batch_text_or_text_pairs)
+        if num_workers > 1 and len(batch_text_or_text_pairs) > 1:
+            num_workers = min(num_workers, len(batch_text_or_text_pairs))
+            div, mod = divmod(len(batch_text_or_text_pairs), num_workers)
+            starts = [div * index + min(index, mod) for index in range(num_workers + 1)]
+            # Shards are encoded sequentially in the workers. The pool is terminated
+            # on exit, so it doesn't leak when a worker raises.
+            kwds["num_workers"] = 0
+            with Pool(num_workers, initargs=(RLock(),)) as pool:
+                results = [
+                    pool.apply_async(
+                        self.batch_encode, args=(batch_text_or_text_pairs[starts[rank] : starts[rank + 1]],), kwds=kwds
+                    )
+                    for rank in range(num_workers)
+                ]
+                transformed_shards = [r.get() for r in results]
+
+            batch_encode_inputs = []
+            for rank in range(num_workers):
+                for encoded_inputs in transformed_shards[rank]:
+                    # `overflow_to_sample` is the index of example in the shard
+                    if "overflow_to_sample" in encoded_inputs:
+                        encoded_inputs["overflow_to_sample"] += starts[rank]
+                    batch_encode_inputs.append(encoded_inputs)
+            return batch_encode_inputs
+
+        return list(self.batch_encode_iter(batch_text_or_text_pairs, **kwds))
+
+    def batch_encode_iter(
+        self,
+        batch_text_or_text_pairs,
+        max_seq_len=512,
+        pad_to_max_seq_len=False,
+        stride=0,
+        is_split_into_words=False,
+        truncation_strategy="longest_first",
+        return_position_ids=False,
+        return_token_type_ids=True,
+        return_attention_mask=False,
+        return_length=False,
+        return_overflowing_tokens=False,
+        return_special_tokens_mask=False,
+        return_numpy_offsets=False,
+    ):
+        """
+        Generator version of :meth:`batch_encode`. It yields the encoded inputs
+        of each example (or each span of an example when `stride` works) as soon
+        as they are built instead of materializing the whole batch, which allows
+        streaming large inputs into data pipelines.
+
+        Args and yielded dicts are the same as :meth:`batch_encode`, except that
+        `num_workers` is not supported.
+        """
+
         def get_input_ids(text):
             if isinstance(text, str):
-                tokens = self._tokenize(text)
-                return self.convert_tokens_to_ids(tokens)
+                return self._text_to_ids(text)
             elif isinstance(text, (list, tuple)) and len(text) > 0 and isinstance(text[0], str):
                 return self.convert_tokens_to_ids(text)
             elif isinstance(text, (list, tuple)) and len(text) > 0 and isinstance(text[0], int):
@@ -434,7 +716,19 @@ class FunnelTokenizer(BertTokenizer):
                     "Input is not valid. Should be a string, a list/tuple of strings or a list/tuple of integers."
                 )
 
-        batch_encode_inputs = []
+        # Bind methods and properties used per example to locals once, several
+        # of the special token ids are properties which do vocab lookups.
+        num_special_tokens_pair = self.num_special_tokens_to_add(pair=True)
+        build_offset_mapping = self.build_offset_mapping_with_special_tokens
+        build_inputs = self.build_inputs_with_special_tokens
+        build_token_type_ids = self.create_token_type_ids_from_sequences
+        get_special_tokens_mask = self.get_special_tokens_mask
+        rematch = self.rematch
+        encode = self.encode
+        pad_token_id = self.pad_token_id
+        pad_token_type_id = self.pad_token_type_id
+        padding_side = self.padding_side
+
         for example_id, tokens_or_pair_tokens in enumerate(batch_text_or_text_pairs):
             if not isinstance(tokens_or_pair_tokens, (list, tuple)):
                 text, text_pair = tokens_or_pair_tokens, None
@@ -449,34 +743,43 @@ class FunnelTokenizer(BertTokenizer):
             if stride > 0 and second_ids is not None:
 
                 max_len_for_pair = (
-                    max_seq_len - len(first_ids) - self.num_special_tokens_to_add(pair=True)
-                )  # need -4  <sep> A </sep> </sep> B <sep>
+                    max_seq_len - len(first_ids) - num_special_tokens_pair
+                )  # need -3  <cls> A <sep> B <sep>
 
-                token_offset_mapping = self.rematch(text)
-                token_pair_offset_mapping = self.rematch(text_pair)
+                token_offset_mapping = rematch(text, return_numpy_offsets=return_numpy_offsets)
+                token_pair_offset_mapping = rematch(text_pair, return_numpy_offsets=return_numpy_offsets)
 
+                # Each span of `second_ids` is `[span_start, span_end)`, only the span itself is sliced
+                num_second_ids = len(second_ids)
+                span_step = max_len_for_pair - stride
+                span_start = 0
                 while True:
                     encoded_inputs = {}
 
                     ids = first_ids
                     mapping = token_offset_mapping
-                    if len(second_ids) <= max_len_for_pair:
+                    span_end = span_start + max_len_for_pair
+                    is_last_span = num_second_ids <= span_end
+                    if is_last_span and span_start == 0:
                         pair_ids = second_ids
                         pair_mapping = token_pair_offset_mapping
+                    elif is_last_span:
+                        pair_ids = second_ids[span_start:]
+                        pair_mapping = token_pair_offset_mapping[span_start:]
                     else:
-                        pair_ids = second_ids[:max_len_for_pair]
-                        pair_mapping = token_pair_offset_mapping[:max_len_for_pair]
+                        pair_ids = second_ids[span_start:span_end]
+                        pair_mapping = token_pair_offset_mapping[span_start:span_end]
 
-                    offset_mapping = self.build_offset_mapping_with_special_tokens(mapping, pair_mapping)
-                    sequence = self.build_inputs_with_special_tokens(ids, pair_ids)
-                    token_type_ids = self.create_token_type_ids_from_sequences(ids, pair_ids)
+                    offset_mapping = build_offset_mapping(mapping, pair_mapping)
+                    sequence = build_inputs(ids, pair_ids)
+                    token_type_ids = build_token_type_ids(ids, pair_ids)
 
                     # Build output dictionnary
                     encoded_inputs["input_ids"] = sequence
                     if return_token_type_ids:
                         encoded_inputs["token_type_ids"] = token_type_ids
                     if return_special_tokens_mask:
-                        encoded_inputs["special_tokens_mask"] = self.get_special_tokens_mask(ids, pair_ids)
+                        encoded_inputs["special_tokens_mask"] = get_special_tokens_mask(ids, pair_ids)
                     if return_length:
                         encoded_inputs["seq_len"] = len(encoded_inputs["input_ids"])
 
@@ -491,43 +794,40 @@ class FunnelTokenizer(BertTokenizer):
                     encoded_inputs["offset_mapping"] = offset_mapping
 
                     if needs_to_be_padded:
+                        # All outputs are freshly built lists, so pad them in place instead of
+                        # concatenating into new lists.
                         difference = max_seq_len - len(encoded_inputs["input_ids"])
-                        if self.padding_side == "right":
+                        if padding_side == "right":
                             if return_attention_mask:
-                                encoded_inputs["attention_mask"] = [1] * len(encoded_inputs["input_ids"]) + [
-                                    0
-                                ] * difference
+                                # built as bytes so no intermediate lists are created
+                                encoded_inputs["attention_mask"] = list(
+                                    b"\x01" * len(encoded_inputs["input_ids"]) + bytes(difference)
+                                )
                             if return_token_type_ids:
                                 # 0 for padding token mask
-                                encoded_inputs["token_type_ids"] = (
-                                    encoded_inputs["token_type_ids"] + [self.pad_token_type_id] * difference
-                                )
+                                encoded_inputs["token_type_ids"].extend(repeat(pad_token_type_id, difference))
                             if return_special_tokens_mask:
-                                encoded_inputs["special_tokens_mask"] = (
-                                    encoded_inputs["special_tokens_mask"] + [1] * difference
-                                )
-                            encoded_inputs["input_ids"] = (
-                                encoded_inputs["input_ids"] + [self.pad_token_id] * difference
-                            )
-                            encoded_inputs["offset_mapping"] = encoded_inputs["offset_mapping"] + [(0, 0)] * difference
-                        elif self.padding_side == "left":
+                                encoded_inputs["special_tokens_mask"].extend(repeat(1, difference))
+                            encoded_inputs["input_ids"].extend(repeat(pad_token_id, difference))
+                            if return_numpy_offsets:
+                                encoded_inputs["offset_mapping"] = np.pad(offset_mapping, ((0, difference), (0, 0)))
+                            else:
+                                encoded_inputs["offset_mapping"].extend(repeat((0, 0), difference))
+                        elif padding_side == "left":
                             if return_attention_mask:
-                                encoded_inputs["attention_mask"] = [0] * difference + [1] * len(
-                                    encoded_inputs["input_ids"]
+                                encoded_inputs["attention_mask"] = list(
+                                    bytes(difference) + b"\x01" * len(encoded_inputs["input_ids"])
                                 )
                             if return_token_type_ids:
                                 # 0 for padding token mask
-                                encoded_inputs["token_type_ids"] = [
-                                    self.pad_token_type_id
-                                ] * difference + encoded_inputs["token_type_ids"]
+                                encoded_inputs["token_type_ids"][:0] = [pad_token_type_id] * difference
                             if return_special_tokens_mask:
-                                encoded_inputs["special_tokens_mask"] = [1] * difference + encoded_inputs[
-                                    "special_tokens_mask"
-                                ]
-                            encoded_inputs["input_ids"] = [self.pad_token_id] * difference + encoded_inputs[
-                                "input_ids"
-                            ]
-                            encoded_inputs["offset_mapping"] = [(0, 0)] * difference + encoded_inputs["offset_mapping"]
+                                encoded_inputs["special_tokens_mask"][:0] = [1] * difference
+                            encoded_inputs["input_ids"][:0] = [pad_token_id] * difference
+                            if return_numpy_offsets:
+                                encoded_inputs["offset_mapping"] = np.pad(offset_mapping, ((difference, 0), (0, 0)))
+                            else:
+                                encoded_inputs["offset_mapping"][:0] = [(0, 0)] * difference
                     else:
                         if return_attention_mask:
                             encoded_inputs["attention_mask"] = [1] * len(encoded_inputs["input_ids"])
@@ -536,68 +836,73 @@ class FunnelTokenizer(BertTokenizer):
                         encoded_inputs["position_ids"] = list(range(len(encoded_inputs["input_ids"])))
 
                     encoded_inputs["overflow_to_sample"] = example_id
-                    batch_encode_inputs.append(encoded_inputs)
+                    yield encoded_inputs
 
-                    if len(second_ids) <= max_len_for_pair:
+                    if is_last_span:
                         break
+                    elif span_step >= 0:
+                        span_start += span_step
                     else:
-                        second_ids = second_ids[max_len_for_pair - stride :]
-                        token_pair_offset_mapping = token_pair_offset_mapping[max_len_for_pair - stride :]
+                        # `stride` is larger than the span, keep the last `-span_step` ids
+                        span_start = max(span_start, num_second_ids + span_step)
 
             else:
-                batch_encode_inputs.append(
-                    self.encode(
-                        first_ids,
-                        second_ids,
-                        max_seq_len=max_seq_len,
-                        pad_to_max_seq_len=pad_to_max_seq_len,
-                        truncation_strategy=truncation_strategy,
-                        return_position_ids=return_position_ids,
-                        return_token_type_ids=return_token_type_ids,
-                        return_attention_mask=return_attention_mask,
-                        return_length=return_length,
-                        return_overflowing_tokens=return_overflowing_tokens,
-                        return_special_tokens_mask=return_special_tokens_mask,
-                    )
+                yield encode(
+                    first_ids,
+                    second_ids,
+                    max_seq_len=max_seq_len,
+                    pad_to_max_seq_len=pad_to_max_seq_len,
+                    truncation_strategy=truncation_strategy,
+                    return_position_ids=return_position_ids,
+                    return_token_type_ids=return_token_type_ids,
+                    return_attention_mask=return_attention_mask,
+                    return_length=return_length,
+                    return_overflowing_tokens=return_overflowing_tokens,
+                    return_special_tokens_mask=return_special_tokens_mask,
                 )
 
-        return batch_encode_inputs
-
-    def rematch(self, text):
+    def rematch(self, text, return_numpy_offsets=False):
         """
         changed from https://github.com/bojone/bert4keras/blob/master/bert4keras/tokenizers.py#L372
+
+        Returns a list of `(start, end)` char offsets in `text` for each token, or an
+        int32 `numpy.ndarray` of shape `[num_tokens, 2]` if `return_numpy_offsets` is `True`.
         """
         tokens = self.custom_tokenize(text)
 
-        normalized_text, char_mapping = "", []
-
-        for i, ch in enumerate(text):
-            if self.basic_tokenizer.do_lower_case:
-                ch = ch.lower()
-                ch = unicodedata.normalize("NFD", ch)
-                ch = "".join([c for c in ch if unicodedata.category(c) != "Mn"])
+        table = _REMATCH_TABLES[bool(self.basic_tokenizer.do_lower_case)]
+        normalized_text = text.translate(table)
 
-            ch = "".join([c for c in ch if not (ord(c) == 0 or ord(c) == 0xFFFD or _is_control(c))])
-            normalized_text += ch
-
-            char_mapping.extend([i] * len(ch))
+        if table.irregular.isdisjoint(map(ord, text)):
+            # every char is normalized into exactly one char
+            char_mapping = list(range(len(text)))
+        else:
+            char_mapping = []
+            for i, ch in enumerate(text):
+                char_mapping.extend([i] * len(table[ord(ch)]))
 
-        text, token_mapping, offset = normalized_text, [], 0
+        text, starts, ends, offset = normalized_text, [], [], 0
 
         for token in tokens:
-            token = stem(token)
+            # strip the wordpiece prefix
+            if token.startswith("##"):
+                token = token[2:]
 
-            start = text[offset:].index(token) + offset
+            start = text.index(token, offset)
             end = start + len(token)
 
-            token_mapping.append((char_mapping[start], char_mapping[end - 1] + 1))
+            starts.append(start)
+            ends.append(end)
             offset = end
 
-        return token_mapping
+        if return_numpy_offsets:
+            char_mapping = np.asarray(char_mapping, dtype=np.int32)
+            token_mapping = np.empty((len(starts), 2), dtype=np.int32)
+            token_mapping[:, 0] = char_mapping[np.asarray(starts, dtype=np.int64)]
+            token_mapping[:, 1] = char_mapping[np.asarray(ends, dtype=np.int64) - 1] + 1
+            return token_mapping
+
+        return [(char_mapping[start], char_mapping[end - 1] + 1) for start, end in zip(starts, ends)]
 
     def custom_tokenize(self, text):
-        split_tokens = []
-        for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token if sub_token != self.unk_token else token)
-        return split_tokens
+        return self._tokenize_impl(text)[1]
@@ -0,0 +1,239 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from paddlenlp.transformers import BasicTokenizer, FunnelTokenizer
+from paddlenlp.transformers.funnel.tokenizer import (
+    _BASIC_TOKENIZE_TABLES,
+    _FunnelBasicTokenizer,
+)
+
+
+def longest_first_reference(ids, pair_ids, num_tokens_to_remove, stride):
+    # The iterative "remove one token from the longest sequence" implementation
+    # which `FunnelTokenizer.truncate_sequences` computes in closed form.
+    overflowing_tokens = []
+    if pair_ids is None or len(ids) <= len(pair_ids):
+        for _ in range(num_tokens_to_remove):
+            if pair_ids is None or len(ids) >= len(pair_ids):
+                overflowing_tokens = [ids[-1]] + overflowing_tokens
+                ids = ids[:-1]
+            else:
+                pair_ids = pair_ids[:-1]
+    else:
+        for _ in range(num_tokens_to_remove):
+            if pair_ids is None or len(ids) > len(pair_ids):
+                overflowing_tokens = [ids[-1]] + overflowing_tokens
+                ids = ids[:-1]
+            else:
+                pair_ids = pair_ids[:-1]
+    window_len = min(len(ids), stride)
+    if window_len > 0:
+        overflowing_tokens = ids[-window_len:] + overflowing_tokens
+    return ids, pair_ids, overflowing_tokens
+
+
+class FunnelTokenizationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        vocab_tokens = [
+            "<unk>",
+            "<sep>",
+            "<pad>",
+            "<cls>",
+            "<mask>",
+            "<s>",
+            "</s>",
+            "want",
+            "##want",
+            "##ed",
+            "wa",
+            "un",
+            "runn",
+            "##ing",
+            ",",
+            ".",
+            "low",
+            "lowest",
+            "the",
+            "is",
+            "what",
+            "?",
+        ]
+        self.vocab_file = os.path.join(self.tmpdirname, FunnelTokenizer.resource_files_names["vocab_file"])
+        with open(self.vocab_file, "w", encoding="utf-8") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+        self.tokenizer = FunnelTokenizer(self.vocab_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdirname)
+
+    def test_full_tokenizer(self):
+        tokens = self.tokenizer.tokenize("UNwantéd,running")
+        self.assertListEqual(tokens, ["un", "##want", "##ed", ",", "runn", "##ing"])
+        self.assertListEqual(self.tokenizer.convert_tokens_to_ids(tokens), [11, 8, 9, 14, 12, 13])
+
+    def test_truncate_longest_first(self):
+        for len_ids in range(8):
+            for len_pair in [None] + list(range(8)):
+                for num_tokens_to_remove in range(1, 17):
+                    for stride in [0, 1, 3]:
+                        ids = list(range(100, 100 + len_ids))
+                        pair_ids = None if len_pair is None else list(range(200, 200 + len_pair))
+                        args = (ids, pair_ids, num_tokens_to_remove)
+                        try:
+                            expected = longest_first_reference(*args, stride)
+                        except IndexError:
+                            with self.assertRaises(IndexError):
+                                self.tokenizer.truncate_sequences(*args, "longest_first", stride)
+                            continue
+                        result = self.tokenizer.truncate_sequences(*args, "longest_first", stride)
+                        self.assertEqual(result, expected, msg=str((len_ids, len_pair, num_tokens_to_remove, stride)))
+
+    def get_batch_text_pairs(self):
+        questions = ["what is the lowest ?", "what is wanted ?", "the running", "low"]
+        contexts = [
+            "the lowest is low , the wanted is running .",
+            "unwanted running , lowest want .",
+            "low " * 20,
+            "what",
+        ]
+        return list(zip(questions, contexts))
+
+    def test_batch_encode_num_workers(self):
+        batch_text_pairs = self.get_batch_text_pairs()
+        for max_seq_len, stride in [(64, 0), (12, 2)]:
+            expected = self.tokenizer.batch_encode(batch_text_pairs, max_seq_len=max_seq_len, stride=stride)
+            result = self.tokenizer.batch_encode(
+                (pair for pair in batch_text_pairs), max_seq_len=max_seq_len, stride=stride, num_workers=2
+            )
+            self.assertEqual(result, expected)
+            if stride > 0:
+                # spans of later examples are encoded in the second shard
+                self.assertEqual(
+                    [encoded_inputs["overflow_to_sample"] for encoded_inputs in result],
+                    [encoded_inputs["overflow_to_sample"] for encoded_inputs in expected],
+                )
+                self.assertEqual(result[-1]["overflow_to_sample"], len(batch_text_pairs) - 1)
+
+    def test_batch_encode_num_workers_env(self):
+        batch_text_pairs = self.get_batch_text_pairs()
+        expected = self.tokenizer.batch_encode(batch_text_pairs, max_seq_len=12, stride=2, num_workers=0)
+        os.environ["PPNLP_TOKENIZER_NUM_WORKERS"] = "2"
+        try:
+            result = self.tokenizer.batch_encode(batch_text_pairs, max_seq_len=12, stride=2)
+        finally:
+            os.environ.pop("PPNLP_TOKENIZER_NUM_WORKERS")
+        self.assertEqual(result, expected)
+
+    def test_batch_encode_iter(self):
+        batch_text_pairs = self.get_batch_text_pairs()
+        for max_seq_len, stride in [(64, 0), (12, 2)]:
+            for pad_to_max_seq_len in [False, True]:
+                kwargs = dict(
+                    max_seq_len=max_seq_len,
+                    stride=stride,
+                    pad_to_max_seq_len=pad_to_max_seq_len,
+                    return_attention_mask=True,
+                    return_special_tokens_mask=True,
+                )
+                encoded_iter = self.tokenizer.batch_encode_iter(batch_text_pairs, **kwargs)
+                self.assertNotIsInstance(encoded_iter, list)
+                self.assertEqual(list(encoded_iter), self.tokenizer.batch_encode(batch_text_pairs, **kwargs))
+
+    def test_rematch_numpy_offsets(self):
+        for text in ["UNwantéd,running", "the lowest is low", ""]:
+            offsets = self.tokenizer.rematch(text, return_numpy_offsets=True)
+            self.assertIsInstance(offsets, np.ndarray)
+            self.assertEqual(offsets.dtype, np.int32)
+            self.assertEqual(offsets.shape, (len(self.tokenizer.tokenize(text)), 2))
+            self.assertEqual([tuple(offset) for offset in offsets.tolist()], self.tokenizer.rematch(text))
+
+    def test_batch_encode_numpy_offsets(self):
+        batch_text_pairs = self.get_batch_text_pairs()
+        for padding_side in ["right", "left"]:
+            self.tokenizer.padding_side = padding_side
+            for pad_to_max_seq_len in [False, True]:
+                kwargs = dict(max_seq_len=12, stride=2, pad_to_max_seq_len=pad_to_max_seq_len)
+                expected = self.tokenizer.batch_encode(batch_text_pairs, **kwargs)
+                result = self.tokenizer.batch_encode(batch_text_pairs, return_numpy_offsets=True, **kwargs)
+                self.assertEqual(len(result), len(expected))
+                for encoded_inputs, expected_inputs in zip(result, expected):
+                    offset_mapping = encoded_inputs.pop("offset_mapping")
+                    expected_offset_mapping = expected_inputs.pop("offset_mapping")
+                    self.assertIsInstance(offset_mapping, np.ndarray)
+                    self.assertEqual(offset_mapping.dtype, np.int32)
+                    self.assertEqual(len(offset_mapping), len(encoded_inputs["input_ids"]))
+                    self.assertEqual([tuple(offset) for offset in offset_mapping.tolist()], expected_offset_mapping)
+                    self.assertEqual(encoded_inputs, expected_inputs)
+
+
+class FunnelBasicTokenizationTest(unittest.TestCase):
+    # `_FunnelBasicTokenizer` reimplements the per-character steps of `BasicTokenizer`,
+    # these tests keep the two in sync for every combination of settings.
+    settings = list(itertools.product([True, False], [None, True, False], [True, False]))
+
+    def get_tokenizers(self, do_lower_case, strip_accents, tokenize_chinese_chars):
+        kwargs = dict(
+            do_lower_case=do_lower_case, strip_accents=strip_accents, tokenize_chinese_chars=tokenize_chinese_chars
+        )
+        return BasicTokenizer(**kwargs), _FunnelBasicTokenizer(**kwargs)
+
+    def test_code_point_sweep(self):
+        # BMP, SMP and SIP, and the tags and variation selectors supplement
+        code_points = [cp for cp in range(0x30000) if not 0xD800 <= cp < 0xE000] + list(range(0xE0000, 0xE1000))
+        for setting in self.settings:
+            # use fresh tables so that the sweep doesn't leave them filled
+            with mock.patch.dict(_BASIC_TOKENIZE_TABLES, clear=True):
+                tokenizer, funnel_tokenizer = self.get_tokenizers(*setting)
+                funnel_tokenizer.tokenize(" ")
+                table = _BASIC_TOKENIZE_TABLES[setting]
+                for start in range(0, len(code_points), 0x1000):
+                    block = code_points[start : start + 0x1000]
+                    for cp in block:
+                        table[cp]
+                    # unsafe code points fall back to `BasicTokenizer` for the whole text
+                    text = " ".join([chr(cp) for cp in block if cp not in table.unsafe])
+                    self.assertEqual(
+                        funnel_tokenizer.tokenize(text), tokenizer.tokenize(text), msg=str((setting, hex(block[0])))
+                    )
+                for cp in table.unsafe:
+                    text = "a%sb %s" % (chr(cp), chr(cp))
+                    self.assertEqual(funnel_tokenizer.tokenize(text), tokenizer.tokenize(text), msg=str(setting))
+
+    def test_random_text(self):
+        rng = random.Random(2023)
+        alphabet = (
+            "abcXYZ \t\n\r\x00\ufffd\x7f.,!?'-$^`"
+            "éÅñüÇ\u0301\u0308\u0345\u05b0\u0903\u093f"
+            "ΣσςΑΩ\u0130İıﬁß中国人の日本語한국어ḱṷ\U0001d16d\U00020000"
+        )
+        for setting in self.settings:
+            tokenizer, funnel_tokenizer = self.get_tokenizers(*setting)
+            for _ in range(300):
+                text = "".join(
+                    rng.choice(alphabet) if rng.random() < 0.9 else chr(rng.randrange(0x30000))
+                    for _ in range(rng.randint(0, 40))
+                )
+                text = text.encode("utf-8", "replace").decode("utf-8")
+                self.assertEqual(funnel_tokenizer.tokenize(text), tokenizer.tokenize(text), msg=repr((setting, text)))